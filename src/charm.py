@@ -12,44 +12,108 @@ develop a new k8s charm using the Operator Framework:
 https://discourse.charmhub.io/t/4208
 """
 
+import hashlib
+import json
 import logging
 import os
+import re
 import subprocess
+import tempfile
 from base64 import b64decode
-from typing import Optional, Union
+from functools import cached_property
+from typing import Any, Dict, Optional, Union
 
-import yaml
 from charms.operator_libs_linux.v1 import snap
-from ops.charm import ActionEvent, CharmBase, ConfigChangedEvent, InstallEvent, RelationEvent
+from ops.charm import (
+    ActionEvent,
+    CharmBase,
+    ConfigChangedEvent,
+    InstallEvent,
+    RelationEvent,
+    UpgradeCharmEvent,
+)
+from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, ModelError
+from ops.model import ActiveStatus, BlockedStatus, ModelError, WaitingStatus
 
 logger = logging.getLogger(__name__)
 
 VALID_LOG_LEVELS = ["info", "debug", "warning", "error", "critical"]
 
+# Characters that JSON emits verbatim, but YAML either forbids in a stream or treats as line breaks
+_YAML_UNSAFE_CHARS = re.compile("[\x7f-\x9f\u2028\u2029\ufeff\ufffe\uffff]")
+
+
+class MissingConfigError(Exception):
+    """Raised when charm config options required by the snap configuration are not set."""
+
+
+def _file_sha256(path: str) -> str:
+    """Return hex encoded SHA-256 digest of a file content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _emit_config(config: Dict[str, Any]) -> bytes:
+    """Serialize snap configuration.
+
+    Configuration is emitted as JSON document which, being a subset of YAML, can be
+    consumed by the collector as a regular YAML config file.
+
+    :param config: Snap configuration.
+    :return: UTF-8 encoded config document.
+    """
+    # Non-ASCII characters are emitted verbatim, because YAML parsers don't accept JSON's
+    # surrogate pair escapes of characters outside the Basic Multilingual Plane.
+    document = json.dumps(config, indent=2, ensure_ascii=False)
+    document = _YAML_UNSAFE_CHARS.sub(lambda match: f"\\u{ord(match.group()):04x}", document)
+    return (document + "\n").encode("UTF-8")
+
 
 class CharmSoftwareInventoryCollectorCharm(CharmBase):
     """Charm the service."""
 
     COLLECTOR_SNAP = "software-inventory-collector"
     CONFIG_PATH = f"/var/snap/{COLLECTOR_SNAP}/current/collector.yaml"
+    CONFIG_HASH_PATH = f"{CONFIG_PATH}.hash"
+    CONFIG_OPTIONS = (
+        "customer",
+        "site",
+        "collection_path",
+        "juju_endpoint",
+        "juju_username",
+        "juju_password",
+        "juju_ca_cert",
+    )
+
+    _stored = StoredState()
 
     def __init__(self, *args) -> None:
         super().__init__(*args)
-        self._snap_path: Optional[str] = None
-        self._is_snap_path_cached = False
-
-        self.framework.observe(self.on.config_changed, self._reconfigure_snap)
-        self.framework.observe(self.on.install, self._on_install)
-        self.framework.observe(self.on.upgrade_charm, self._on_install)
-        self.framework.observe(self.on.collect_action, self._on_collect_action)
-        self.framework.observe(self.on.inventory_exporter_relation_changed, self._reconfigure_snap)
-        self.framework.observe(
-            self.on.inventory_exporter_relation_departed, self._reconfigure_snap
+        self._stored.set_default(
+            verified_config_hash=None,
+            ca_cert_b64=None,
+            ca_cert=None,
+            local_snap_hash=None,
         )
-
-    @property
+        self._config_hash: Optional[str] = None
+        self._target_count: Optional[int] = None
+
+        for event, handler in (
+            (self.on.config_changed, self._reconfigure_snap),
+            (self.on.install, self._on_install),
+            (self.on.upgrade_charm, self._on_install),
+            (self.on.collect_action, self._on_collect_action),
+            (self.on.inventory_exporter_relation_changed, self._reconfigure_snap),
+            (self.on.inventory_exporter_relation_departed, self._reconfigure_snap),
+        ):
+            self.framework.observe(event, handler)
+
+    @cached_property
     def snap_path(self) -> Optional[str]:
         """Get local path to exporter snap.
 
@@ -57,23 +121,21 @@ class CharmSoftwareInventoryCollectorCharm(CharmBase):
         path to the snap file. If the resource was not attached of the file is empty, this property
         returns None.
         """
-        if not self._is_snap_path_cached:
-            try:
-                self._snap_path = str(self.model.resources.fetch("collector-snap"))
-                # Don't return path to empty resource file
-                if not os.path.getsize(self._snap_path) > 0:
-                    self._snap_path = None
-            except ModelError:
-                self._snap_path = None
-            finally:
-                self._is_snap_path_cached = True
-
-        return self._snap_path
+        try:
+            resource_path = self.model.resources.fetch("collector-snap")
+        except ModelError:
+            return None
+
+        # Don't return path to empty resource file
+        return str(resource_path) if resource_path.stat().st_size > 0 else None
 
     def run_collector(self, dry_run: bool = False) -> bool:
         """Execute collector command.
 
-        Any output from the command will be logged.
+        If the command fails, its error output is logged. Standard output is logged as well if
+        it was captured, which is always the case for the dry run (its output is small and
+        explains why the verification failed). Standard output of the full collection run is
+        captured only if debug logging is enabled.
 
         If dry_run is True, the command will only verify valid config and ability
         to connect to data sources without actually collecting data.
@@ -85,82 +147,204 @@ class CharmSoftwareInventoryCollectorCharm(CharmBase):
         if dry_run:
             cmd.append("--dry-run")
 
-        cmd_string = " ".join(cmd)
-        try:
-            result = subprocess.check_output(cmd)
-        except subprocess.CalledProcessError as exc:
-            logger.error("Execution of '%s' failed: %s", cmd_string, exc.output)
-            success = False
-        else:
-            logger.debug("Execution of '%s' successful: %s", cmd_string, result.decode("UTF-8"))
-            success = True
+        capture_stdout = dry_run or logger.isEnabledFor(logging.DEBUG)
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=False,
+        )
+        if result.returncode != 0:
+            stdout = result.stdout if capture_stdout else "(not captured)"
+            logger.error(
+                "Execution of %r failed.\nstdout: %s\nstderr: %s", cmd, stdout, result.stderr
+            )
+            return False
 
-        return success
+        logger.debug("Execution of %r successful: %s", cmd, result.stdout)
+        return True
 
-    def _on_install(self, _: InstallEvent) -> None:
+    @property
+    def is_snap_installed(self) -> bool:
+        """Check whether collector snap is installed on the unit."""
+        try:
+            return snap.SnapCache()[self.COLLECTOR_SNAP].present
+        except snap.SnapNotFoundError:
+            return False
+
+    def _on_install(self, event: Union[InstallEvent, UpgradeCharmEvent]) -> None:
         """Trigger snap installation.
 
-        If 'collector-snap' resource is attached to the charm,
+        If 'collector-snap' resource is attached to the charm, snap is installed from the
+        resource, otherwise it's installed from the Snap Store. Installation from the resource
+        is skipped if the same resource file is already installed. Installation from the Snap
+        Store is skipped only during "install" hook if the snap is already present, on
+        "upgrade-charm" the snap is always refreshed.
         """
         if self.snap_path:
-            snap.install_local(self.snap_path, dangerous=True)
+            snap_hash = _file_sha256(self.snap_path)
+            if snap_hash == self._stored.local_snap_hash and self.is_snap_installed:
+                logger.info("Collector snap from attached resource is already installed.")
+            else:
+                snap.install_local(self.snap_path, dangerous=True)
+                self._stored.local_snap_hash = snap_hash
+        elif (
+            isinstance(event, InstallEvent)
+            and self._stored.local_snap_hash is None
+            and self.is_snap_installed
+        ):
+            logger.info("Collector snap is already installed from Snap Store.")
         else:
             snap.ensure(snap_names=self.COLLECTOR_SNAP, state=str(snap.SnapState.Latest))
+            self._stored.local_snap_hash = None
 
         self.assess_status()
 
     def _reconfigure_snap(self, _: Union[RelationEvent, ConfigChangedEvent]) -> None:
         """Trigger snap reconfiguration."""
-        self.render_config()
+        try:
+            self.render_config()
+        except MissingConfigError as exc:
+            logger.error("Unable to render snap configuration: %s", exc)
+            self.unit.status = BlockedStatus(f"Missing required config: {exc}")
+            return
+
         self.assess_status()
 
-    def render_config(self) -> None:
+    def render_config(self) -> bool:
         """Generate snap configuration.
 
         Sources for the configuration are charm config options and data from relation
-        with exporter charms.
+        with exporter charms. Config file is rewritten only if its content changed since
+        the last render.
+
+        :return: True if config file was (re)written, False if it was already up to date.
+        :raises MissingConfigError: If any of the required charm config options is empty.
         """
+        cfg = {option: self.config.get(option) for option in self.CONFIG_OPTIONS}
+        missing = [option for option, value in cfg.items() if not value]
+        if missing:
+            raise MissingConfigError(", ".join(missing))
+
+        customer = cfg["customer"]
+        site = cfg["site"]
+        collection_path = cfg["collection_path"]
+        endpoint = cfg["juju_endpoint"]
+        username = cfg["juju_username"]
+        password = cfg["juju_password"]
+        ca_cert_b64 = cfg["juju_ca_cert"]
+
+        exporter_relations = self.model.relations.get("inventory-exporter") or ()
+        targets = [
+            {
+                "endpoint": remote_data["private-address"] + ":" + remote_data["port"],
+                "hostname": remote_data.get("hostname"),
+                "customer": customer,
+                "site": site,
+                "model": remote_data.get("model"),
+            }
+            for relation in exporter_relations
+            for unit in relation.units
+            for remote_data in (relation.data[unit],)
+            # Skip units that did not publish their endpoint yet
+            if "private-address" in remote_data and "port" in remote_data
+        ]
+
         config = {
-            "settings": {},
-            "juju_controller": {},
-            "targets": [],
+            "settings": {
+                "collection_path": collection_path,
+                "customer": customer,
+                "site": site,
+            },
+            "juju_controller": {
+                "endpoint": endpoint,
+                "username": username,
+                "password": password,
+                "ca_cert": self._decode_ca_cert(ca_cert_b64),
+            },
+            "targets": targets,
         }
 
-        customer = self.config.get("customer")
-        site = self.config.get("site")
-        ca_cert = b64decode(self.config.get("juju_ca_cert")).decode("UTF-8")
-
-        config["settings"]["collection_path"] = self.config.get("collection_path")
-        config["settings"]["customer"] = customer
-        config["settings"]["site"] = site
-        config["juju_controller"]["endpoint"] = self.config.get("juju_endpoint")
-        config["juju_controller"]["username"] = self.config.get("juju_username")
-        config["juju_controller"]["password"] = self.config.get("juju_password")
-        config["juju_controller"]["ca_cert"] = ca_cert
-
-        for relation in self.model.relations.get("inventory-exporter"):
-            for unit in relation.units:
-                remote_data = relation.data[unit]
-                endpoint = f"{remote_data.get('private-address')}:{remote_data.get('port')}"
-                config["targets"].append(
-                    {
-                        "endpoint": endpoint,
-                        "hostname": remote_data.get("hostname"),
-                        "customer": customer,
-                        "site": site,
-                        "model": remote_data.get("model"),
-                    }
-                )
-
-        with open(self.CONFIG_PATH, "w", encoding="UTF-8") as conf_file:
-            yaml.safe_dump(config, conf_file)
+        self._target_count = len(targets)
+        data = _emit_config(config)
+        self._config_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if self._config_hash == self._read_config_hash() and os.path.exists(self.CONFIG_PATH):
+            logger.debug("Snap configuration is up to date.")
+            return False
+
+        self._write_config(data)
+        with open(self.CONFIG_HASH_PATH, "w", encoding="UTF-8") as hash_file:
+            hash_file.write(self._config_hash)
+
+        return True
+
+    def _decode_ca_cert(self, ca_cert_b64: str) -> str:
+        """Decode base64 encoded CA certificate of juju controller.
+
+        Decoded certificate is cached across hooks and reused as long as the encoded
+        value in charm config does not change.
+
+        :param ca_cert_b64: Base64 encoded CA certificate.
+        :return: Decoded CA certificate.
+        """
+        if ca_cert_b64 != self._stored.ca_cert_b64:
+            self._stored.ca_cert = b64decode(ca_cert_b64).decode("UTF-8")
+            self._stored.ca_cert_b64 = ca_cert_b64
+
+        return self._stored.ca_cert
+
+    def _read_config_hash(self) -> Optional[str]:
+        """Return hash of the last rendered snap configuration, if any."""
+        try:
+            with open(self.CONFIG_HASH_PATH, "r", encoding="UTF-8") as hash_file:
+                return hash_file.read().strip()
+        except OSError:
+            return None
+
+    def _write_config(self, data: bytes) -> None:
+        """Atomically replace snap configuration file.
+
+        Serialized config is written to a temporary file, in the same directory as the
+        config file, in a single write and then moved over the original. Collector therefore
+        never sees partially written config, even if the hook gets interrupted.
+
+        :param data: Serialized snap configuration.
+        """
+        config_dir, config_name = os.path.split(self.CONFIG_PATH)
+        fd, tmp_path = tempfile.mkstemp(dir=config_dir, prefix=f".{config_name}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, self.CONFIG_PATH)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
 
     def assess_status(self) -> None:
-        """Perform overall charm status assessment."""
+        """Perform overall charm status assessment.
+
+        Collector is executed in "dry run" mode to verify rendered config, unless there are
+        no exporter targets to verify yet, or the current config was already successfully
+        verified in one of the previous hooks.
+        """
+        if self._target_count == 0:
+            self.unit.status = WaitingStatus("Waiting for exporter relation.")
+            return
+
+        if self._config_hash is not None and (
+            self._config_hash == self._stored.verified_config_hash
+        ):
+            logger.debug("Snap configuration was already verified.")
+            self.unit.status = ActiveStatus("Unit ready.")
+            return
+
         collector_ok = self.run_collector(dry_run=True)
         if collector_ok:
+            self._stored.verified_config_hash = self._config_hash
             self.unit.status = ActiveStatus("Unit ready.")
         else:
+            self._stored.verified_config_hash = None
             self.unit.status = BlockedStatus("Collector is unable to run. Please see logs.")
 
     def _on_collect_action(self, action: ActionEvent) -> None:
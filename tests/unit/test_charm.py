@@ -3,13 +3,25 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
 from base64 import b64encode
 from itertools import repeat
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import MagicMock
 
 import charm
 import pytest
-from ops.model import ActiveStatus, BlockedStatus
+import yaml
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
+
+# Minimal charm config that satisfies all required options
+VALID_CONFIG = {
+    "customer": "Test Customer",
+    "site": "Testing Site",
+    "juju_endpoint": "10.0.0.1:17070",
+    "juju_username": "admin",
+    "juju_password": "pass",
+    "juju_ca_cert": b64encode(b"CERT DATA").decode("ascii"),
+}
 
 
 @pytest.mark.parametrize(
@@ -50,55 +62,114 @@ def test_snap_path_property_caching(harness, mocker):
 
 
 @pytest.mark.parametrize(
-    "dry_run, expected_success",
+    "dry_run, expected_success, debug",
     [
-        (True, True),  # --dry-run passed
-        (True, False),  # --dry-run failed
-        (False, True),  # full run passed
-        (False, False),  # full run failed
+        (True, True, False),  # --dry-run passed
+        (True, False, False),  # --dry-run failed
+        (False, True, False),  # full run passed
+        (False, False, False),  # full run failed
+        (False, True, True),  # full run passed, output captured for debug log
     ],
 )
-def test_run_collector(dry_run, expected_success, harness, mocker):
+def test_run_collector(dry_run, expected_success, debug, harness, mocker):
     """Test executing collector snap and check output/success."""
-    check_output_mock = mocker.patch.object(charm.subprocess, "check_output")
+    run_mock = mocker.patch.object(charm.subprocess, "run")
+    mocker.patch.object(charm.logger, "isEnabledFor", return_value=debug)
     expected_cmd = [harness.charm.COLLECTOR_SNAP, "-c", harness.charm.CONFIG_PATH]
     if dry_run:
         expected_cmd.append("--dry-run")
 
-    if not expected_success:
-        error = charm.subprocess.CalledProcessError(1, cmd=expected_cmd, output="CMD failed")
-        check_output_mock.side_effect = error
-    else:
-        check_output_mock.return_value = b"Command OK"
+    return_code = 0 if expected_success else 1
+    run_mock.return_value = charm.subprocess.CompletedProcess(
+        expected_cmd, return_code, stdout="Command output", stderr="Command error"
+    )
 
     cmd_result = harness.charm.run_collector(dry_run=dry_run)
 
-    check_output_mock.assert_called_once_with(expected_cmd)
+    run_mock.assert_called_once_with(
+        expected_cmd,
+        stdout=charm.subprocess.PIPE if dry_run or debug else charm.subprocess.DEVNULL,
+        stderr=charm.subprocess.PIPE,
+        text=True,
+        check=False,
+    )
     assert cmd_result == expected_success
 
 
+def test_run_collector_failure_logs_output(harness, mocker, caplog):
+    """Test that both stdout and stderr of failed dry run are logged."""
+    run_mock = mocker.patch.object(charm.subprocess, "run")
+    run_mock.return_value = charm.subprocess.CompletedProcess(
+        [], 1, stdout="Invalid config", stderr="Traceback"
+    )
+
+    assert not harness.charm.run_collector(dry_run=True)
+
+    assert "stdout: Invalid config" in caplog.text
+    assert "stderr: Traceback" in caplog.text
+
+
 @pytest.mark.parametrize("local_snap", [True, False])
-def test_on_install(local_snap, harness, mocker):
+def test_on_install(local_snap, harness, mocker, tmp_path):
     """Test function that handles snap installation."""
-    snap_path = "/path/to/snap" if local_snap else None
-    harness.charm._snap_path = snap_path
-    harness.charm._is_snap_path_cached = True
+    snap_path = None
+    if local_snap:
+        snap_file = tmp_path / "collector.snap"
+        snap_file.write_bytes(b"snap data")
+        snap_path = str(snap_file)
+    harness.charm.snap_path = snap_path
     assess_status_mock = mocker.patch.object(harness.charm, "assess_status")
     snap_mock = mocker.patch.object(charm, "snap")
+    snap_mock.SnapCache.return_value = {}
+    snap_mock.SnapNotFoundError = KeyError
 
     harness.charm._on_install(None)
 
     if local_snap:
         snap_mock.install_local.assert_called_once_with(snap_path, dangerous=True)
+        assert harness.charm._stored.local_snap_hash == charm._file_sha256(snap_path)
     else:
         expected_state = str(snap_mock.SnapState.Latest)
         snap_mock.ensure.assert_called_once_with(
             snap_names=harness.charm.COLLECTOR_SNAP, state=expected_state
         )
+        assert harness.charm._stored.local_snap_hash is None
 
     assess_status_mock.assert_called_once()
 
 
+@pytest.mark.parametrize(
+    "local_snap, stored_hash, installed, upgrade, expect_install",
+    [
+        (True, "snap-hash", True, False, False),  # Same local snap already installed
+        (True, "snap-hash", True, True, False),  # Same local snap already installed
+        (True, "snap-hash", False, False, True),  # Local snap was removed
+        (True, "old-hash", True, False, True),  # Attached resource changed
+        (True, None, True, False, True),  # Snap was installed from Snap Store
+        (False, None, True, False, False),  # Snap already installed from Snap Store
+        (False, None, True, True, True),  # Snap from Snap Store is refreshed on upgrade
+        (False, None, False, False, True),  # Snap not installed yet
+        (False, "snap-hash", True, False, True),  # Snap was installed from local resource
+    ],
+)
+def test_on_install_already_installed(
+    local_snap, stored_hash, installed, upgrade, expect_install, harness, mocker
+):
+    """Test that snap installation is skipped if the snap is already installed."""
+    harness.charm.snap_path = "/path/to/snap" if local_snap else None
+    harness.charm._stored.local_snap_hash = stored_hash
+    mocker.patch.object(charm, "_file_sha256", return_value="snap-hash")
+    mocker.patch.object(harness.charm, "assess_status")
+    snap_mock = mocker.patch.object(charm, "snap")
+    snap_mock.SnapCache.return_value[harness.charm.COLLECTOR_SNAP].present = installed
+    event = MagicMock(spec=charm.UpgradeCharmEvent if upgrade else charm.InstallEvent)
+
+    harness.charm._on_install(event)
+
+    install_mock = snap_mock.install_local if local_snap else snap_mock.ensure
+    assert install_mock.called == expect_install
+
+
 def test_reconfigure_snap(harness, mocker):
     """Test function that handles changes in snap configuration."""
     render_config_mock = mocker.patch.object(harness.charm, "render_config")
@@ -110,9 +181,51 @@ def test_reconfigure_snap(harness, mocker):
     assess_status_mock.assert_called_once()
 
 
-def test_render_config(harness, mocker):
+def test_reconfigure_snap_missing_config(harness, mocker):
+    """Test that unit is blocked if snap configuration can't be rendered."""
+    mocker.patch.object(
+        harness.charm, "render_config", side_effect=charm.MissingConfigError("customer, site")
+    )
+    assess_status_mock = mocker.patch.object(harness.charm, "assess_status")
+
+    harness.charm._reconfigure_snap(None)
+
+    assess_status_mock.assert_not_called()
+    assert harness.charm.unit.status == BlockedStatus("Missing required config: customer, site")
+
+
+@pytest.mark.parametrize(
+    "unset_options",
+    [
+        ["juju_ca_cert"],
+        ["customer", "site"],
+        list(VALID_CONFIG),
+    ],
+)
+def test_render_config_missing_option(unset_options, harness, mocker):
+    """Test that required charm config options left empty are reported by render_config."""
+    write_config_mock = mocker.patch.object(harness.charm, "_write_config")
+    config = dict(VALID_CONFIG)
+    for option in unset_options:
+        config[option] = ""
+    # Triggers config-changed hook
+    harness.update_config(config)
+
+    expected_status = BlockedStatus(f"Missing required config: {', '.join(unset_options)}")
+    assert harness.charm.unit.status == expected_status
+    with pytest.raises(charm.MissingConfigError) as exc_info:
+        harness.charm.render_config()
+
+    assert str(exc_info.value) == ", ".join(unset_options)
+    write_config_mock.assert_not_called()
+
+
+def test_render_config(harness, mocker, tmp_path):
     """Test function that renders snap configuration."""
-    yaml_dump_mock = mocker.patch.object(charm.yaml, "safe_dump")
+    config_path = tmp_path / "collector.yaml"
+    hash_path = tmp_path / "collector.yaml.hash"
+    mocker.patch.object(harness.charm, "CONFIG_PATH", str(config_path))
+    mocker.patch.object(harness.charm, "CONFIG_HASH_PATH", str(hash_path))
     # Charm config data
     site = "Testing Site"
     customer = "Test Customer"
@@ -186,12 +299,130 @@ def test_render_config(harness, mocker):
         )
 
     # Trigger config generation
-    open_file_function = mock_open()
-    with patch("builtins.open", open_file_function) as file_open_mock:
-        harness.charm.render_config()
-        file_open_mock.assert_called_once_with(harness.charm.CONFIG_PATH, "w", encoding="UTF-8")
+    assert harness.charm.render_config()
+    assert harness.charm._target_count == 1
+
+    assert yaml.safe_load(config_path.read_text(encoding="UTF-8")) == expected_config
+    assert hash_path.read_text(encoding="UTF-8") == harness.charm._config_hash
+    # Temporary file is not left behind after the config file is replaced
+    assert sorted(tmp_path.iterdir()) == [config_path, hash_path]
 
-    yaml_dump_mock.assert_called_once_with(expected_config, open_file_function())
+
+@pytest.mark.parametrize("with_targets", [True, False])
+def test_emit_config(with_targets):
+    """Test that emitted config is valid JSON and YAML that preserves all values."""
+    config = {
+        "settings": {
+            "collection_path": "/tmp/output dir/",
+            "customer": 'Customer "quoted" #1 Acme \U0001f600',
+            "site": "  site: with colon, ünïcode \x85\x7f\u2028\ufeff  ",
+        },
+        "juju_controller": {
+            "endpoint": "10.0.0.1:17070",
+            "username": "admin",
+            "password": "p@ss\\word'",
+            "ca_cert": "--start cert--\nCERT DATA\n--end cert--\n",
+        },
+        "targets": [],
+    }
+    if with_targets:
+        config["targets"] = [
+            {
+                "endpoint": f"10.0.0.{i}:8765",
+                "hostname": f"juju-exporter-{i}",
+                "customer": "Customer",
+                "site": "Site",
+                "model": None,
+            }
+            for i in range(3)
+        ]
+
+    data = charm._emit_config(config)
+
+    assert json.loads(data) == config
+    assert yaml.safe_load(data) == config
+    assert yaml.load(data, Loader=yaml.CSafeLoader) == config
+
+
+def test_decode_ca_cert_caching(harness, mocker):
+    """Test that decoded CA certificate is reused until encoded value changes."""
+    b64decode_mock = mocker.patch.object(charm, "b64decode", wraps=charm.b64decode)
+    cert_1 = b64encode(b"CERT 1").decode("ascii")
+    cert_2 = b64encode(b"CERT 2").decode("ascii")
+
+    assert harness.charm._decode_ca_cert(cert_1) == "CERT 1"
+    assert harness.charm._decode_ca_cert(cert_1) == "CERT 1"
+    b64decode_mock.assert_called_once_with(cert_1)
+
+    assert harness.charm._decode_ca_cert(cert_2) == "CERT 2"
+    assert b64decode_mock.call_count == 2
+
+
+def test_render_config_incomplete_unit_data(harness, mocker, tmp_path):
+    """Test that exporter units without published endpoint are not added to targets."""
+    config_path = tmp_path / "collector.yaml"
+    mocker.patch.object(harness.charm, "CONFIG_PATH", str(config_path))
+    mocker.patch.object(harness.charm, "CONFIG_HASH_PATH", str(tmp_path / "collector.yaml.hash"))
+    with harness.hooks_disabled():
+        harness.update_config(VALID_CONFIG)
+        rel_id = harness.add_relation("inventory-exporter", "software-inventory-exporter")
+        harness.add_relation_unit(rel_id, "software-inventory-exporter/0")
+        harness.add_relation_unit(rel_id, "software-inventory-exporter/1")
+        harness.update_relation_data(
+            rel_id,
+            "software-inventory-exporter/0",
+            {"private-address": "10.0.0.5", "port": "8765", "hostname": "exporter-0"},
+        )
+        harness.update_relation_data(
+            rel_id, "software-inventory-exporter/1", {"hostname": "exporter-1"}
+        )
+
+    harness.charm.render_config()
+
+    targets = yaml.safe_load(config_path.read_text(encoding="UTF-8"))["targets"]
+    assert [target["endpoint"] for target in targets] == ["10.0.0.5:8765"]
+
+
+@pytest.mark.parametrize(
+    "config_exists, hash_matches, expect_write",
+    [
+        (True, True, False),  # Config is up to date, skip writing
+        (True, False, True),  # Config changed
+        (False, True, True),  # Config file was removed
+    ],
+)
+def test_render_config_unchanged(
+    config_exists, hash_matches, expect_write, harness, mocker, tmp_path
+):
+    """Test that config file is written only when its content changes."""
+    config_path = tmp_path / "collector.yaml"
+    hash_path = tmp_path / "collector.yaml.hash"
+    mocker.patch.object(harness.charm, "CONFIG_PATH", str(config_path))
+    mocker.patch.object(harness.charm, "CONFIG_HASH_PATH", str(hash_path))
+    with harness.hooks_disabled():
+        harness.update_config(VALID_CONFIG)
+    harness.charm.render_config()
+    write_config_mock = mocker.patch.object(harness.charm, "_write_config")
+
+    if not config_exists:
+        config_path.unlink()
+    if not hash_matches:
+        hash_path.write_text("outdated", encoding="UTF-8")
+
+    assert harness.charm.render_config() == expect_write
+    assert write_config_mock.called == expect_write
+
+
+def test_write_config_failure_cleanup(harness, mocker, tmp_path):
+    """Test that temporary file is removed if config file can't be replaced."""
+    config_path = tmp_path / "collector.yaml"
+    mocker.patch.object(harness.charm, "CONFIG_PATH", str(config_path))
+    mocker.patch.object(charm.os, "replace", side_effect=OSError)
+
+    with pytest.raises(OSError):
+        harness.charm._write_config(b"settings: {}\n")
+
+    assert list(tmp_path.iterdir()) == []
 
 
 @pytest.mark.parametrize("collector_runs", [True, False])
@@ -200,14 +431,51 @@ def test_assess_status(collector_runs, harness, mocker):
     run_collector_mock = mocker.patch.object(
         harness.charm, "run_collector", return_value=collector_runs
     )
+    harness.charm._config_hash = "config-hash"
 
     harness.charm.assess_status()
 
     run_collector_mock.assert_called_once_with(dry_run=True)
     if collector_runs:
         assert isinstance(harness.charm.unit.status, ActiveStatus)
+        assert harness.charm._stored.verified_config_hash == "config-hash"
     else:
         assert isinstance(harness.charm.unit.status, BlockedStatus)
+        assert harness.charm._stored.verified_config_hash is None
+
+
+@pytest.mark.parametrize(
+    "config_hash, verified_hash, expect_dry_run",
+    [
+        ("config-hash", "config-hash", False),  # Config already verified
+        ("config-hash", "old-hash", True),  # Config changed since last verification
+        ("config-hash", None, True),  # Config was never verified
+        (None, None, True),  # Config was not rendered in this hook
+    ],
+)
+def test_assess_status_verified_config(
+    config_hash, verified_hash, expect_dry_run, harness, mocker
+):
+    """Test that dry run is skipped if current config was already verified."""
+    run_collector_mock = mocker.patch.object(harness.charm, "run_collector", return_value=True)
+    harness.charm._config_hash = config_hash
+    harness.charm._stored.verified_config_hash = verified_hash
+
+    harness.charm.assess_status()
+
+    assert run_collector_mock.called == expect_dry_run
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+
+def test_assess_status_no_targets(harness, mocker):
+    """Test that dry run is skipped if there are no exporter targets."""
+    run_collector_mock = mocker.patch.object(harness.charm, "run_collector")
+    harness.charm._target_count = 0
+
+    harness.charm.assess_status()
+
+    run_collector_mock.assert_not_called()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
 
 
 @pytest.mark.parametrize("action_success", [True, False])